@@ -0,0 +1,183 @@
+import os
+import logging
+from typing import List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+OPTIMIZED_FILE = "model_optimized.onnx"
+QUANTIZED_FILE = "model_optimized_quantized.onnx"
+# Written next to the FAISS index: the embedding_model_id() of the model that built it
+INDEX_MODEL_FILE = "embedding_model.txt"
+
+
+def export_onnx_model(model_name: str, onnx_dir: str):
+    """
+    Export a sentence-transformers model to ONNX once and save it to `onnx_dir`.
+    The graph is fully optimized (level 99). OPTIMIZED_FILE is written last, so it marks a complete export.
+    """
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTOptimizer
+    from optimum.onnxruntime.configuration import OptimizationConfig
+    from transformers import AutoTokenizer
+
+    logger.info(f"Exporting '{model_name}' to ONNX in '{onnx_dir}' (one-time)...")
+    AutoTokenizer.from_pretrained(model_name).save_pretrained(onnx_dir)
+    model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+    optimizer = ORTOptimizer.from_pretrained(model)
+    optimizer.optimize(save_dir=onnx_dir, optimization_config=OptimizationConfig(optimization_level=99))
+
+
+def quantize_onnx_model(onnx_dir: str):
+    """Write an INT8 dynamic-quantized copy (QUANTIZED_FILE) of the optimized model."""
+    from optimum.onnxruntime import ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    logger.info(f"Quantizing ONNX model in '{onnx_dir}' to INT8 (one-time)...")
+    quantizer = ORTQuantizer.from_pretrained(onnx_dir, file_name=OPTIMIZED_FILE)
+    qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    quantizer.quantize(save_dir=onnx_dir, quantization_config=qconfig)
+
+
+class OptimumEmbeddings(Embeddings):
+    """MPNet sentence embeddings served by ONNX Runtime (mean pooling + L2 normalization, as in sbert)."""
+
+    def __init__(
+        self,
+        model_name: str,
+        onnx_dir: str = "mpnet_onnx",
+        quantize: bool = False,
+        batch_size: int = 64,
+        max_seq_length: int = 384,
+    ):
+        import onnxruntime
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        # Check for the model files, not the directory, so an interrupted export is redone
+        if not os.path.exists(os.path.join(onnx_dir, OPTIMIZED_FILE)):
+            export_onnx_model(model_name, onnx_dir)
+        if quantize and not os.path.exists(os.path.join(onnx_dir, QUANTIZED_FILE)):
+            quantize_onnx_model(onnx_dir)
+
+        gpu = "CUDAExecutionProvider" in onnxruntime.get_available_providers()
+        provider = "CUDAExecutionProvider" if gpu else "CPUExecutionProvider"
+        file_name = QUANTIZED_FILE if quantize else OPTIMIZED_FILE
+
+        # Identifies the weights actually served (used to key cached vectors)
+        self.model_id = f"{model_name}|onnx|{file_name}"
+        self.batch_size = batch_size
+        self.max_seq_length = max_seq_length
+        self.tokenizer = AutoTokenizer.from_pretrained(onnx_dir)
+        # IO binding (optimum's default on CUDA) rejects the numpy inputs _encode passes
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            onnx_dir, file_name=file_name, provider=provider, use_io_binding=False
+        )
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            inputs = self.tokenizer(
+                texts[start:start + self.batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np",
+            )
+            inputs = {k: v for k, v in inputs.items() if k in self.model.input_names}
+            token_embeddings = self.model(**inputs).last_hidden_state
+
+            # Mean pooling over real tokens, then L2-normalize
+            mask = inputs["attention_mask"][..., None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            vectors.extend(pooled.tolist())
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._encode(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._encode([text])[0]
+
+
+def _load_torch_embeddings(model_name: str, batch_size: int) -> Embeddings:
+    """PyTorch backend: GPU + FP16 autocast when CUDA is available, encoder wrapped in torch.compile."""
+    # Imported here so ONNX users and ingestion pool workers never pay for torch
+    import torch
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    embeddings = HuggingFaceEmbeddings(
+        model_name=model_name,
+        model_kwargs={"device": device},
+        encode_kwargs={"batch_size": batch_size, "normalize_embeddings": True},
+    )
+    if device == "cuda":
+        encode = embeddings.client.encode
+
+        def encode_fp16(*args, **kwargs):
+            with torch.inference_mode(), torch.amp.autocast("cuda", dtype=torch.float16):
+                return encode(*args, **kwargs)
+
+        embeddings.client.encode = encode_fp16
+
+    # Graph-compile the encoder to cut per-call Python overhead; fall back to eager if inductor is unavailable.
+    # Default mode (no CUDA graphs) with dynamic shapes: every batch is padded to a different length,
+    # so one graph must cover all sequence lengths instead of recompiling per shape.
+    import torch._dynamo
+    torch._dynamo.config.suppress_errors = True  # Compile failures on later shapes fall back to eager
+    module = embeddings.client._first_module()
+    eager_model = module.auto_model
+    try:
+        module.auto_model = torch.compile(eager_model, dynamic=True, fullgraph=False)
+        embeddings.embed_query("warmup")  # Compilation is lazy: pay it now, not on the first real query
+    except Exception as e:
+        logger.warning(f"torch.compile unavailable, using eager model: {e}")
+        module.auto_model = eager_model
+    return embeddings
+
+
+def load_embeddings(
+    model_name: str,
+    backend: str = "onnx",
+    batch_size: int = 64,
+    onnx_dir: str = "mpnet_onnx",
+    quantize: bool = False,
+) -> Embeddings:
+    """Build the embedding model for ingestion and retrieval ('onnx' or 'torch' backend)."""
+    if backend == "onnx":
+        return OptimumEmbeddings(model_name, onnx_dir=onnx_dir, quantize=quantize, batch_size=batch_size)
+    if backend == "torch":
+        return _load_torch_embeddings(model_name, batch_size)
+    raise ValueError(f"Unknown embedding backend '{backend}'. Use 'onnx' or 'torch'.")
+
+
+def embedding_model_id(embeddings: Embeddings) -> str:
+    """Identify the model, backend and weights behind either backend; differs whenever vectors would."""
+    if isinstance(embeddings, OptimumEmbeddings):
+        return embeddings.model_id
+    return f"{embeddings.model_name}|torch|{embeddings.client.device.type}"
+
+
+def get_tokenizer(embeddings: Embeddings):
+    """Return the Hugging Face tokenizer behind either backend."""
+    if isinstance(embeddings, OptimumEmbeddings):
+        return embeddings.tokenizer
+    return embeddings.client.tokenizer
+
+
+def read_index_model_id(persist_dir: str) -> Optional[str]:
+    """Model id recorded with the index in `persist_dir`, or None for an index built before it was recorded."""
+    path = os.path.join(persist_dir, INDEX_MODEL_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return f.read().strip()
+
+
+def write_index_model_id(persist_dir: str, model_id: str):
+    """Record which embedding model built the index in `persist_dir`."""
+    with open(os.path.join(persist_dir, INDEX_MODEL_FILE), 'w') as f:
+        f.write(model_id)
@@ -1,19 +1,30 @@
 import os
 import logging
 import hashlib
-import json
+import multiprocessing
 import re
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass, field
-from typing import List, Dict, Optional
+from functools import lru_cache, partial
+from typing import Iterator, List, Dict, Optional, Tuple
 from pathlib import Path
 
 # Third-party imports
-from langchain_community.document_loaders import PyPDFLoader
+import faiss
+import numpy as np
+from langchain_community.document_loaders import PyMuPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.vectorstores import Chroma
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain_core.documents import Document
 
+import rag_settings
+from embedding_models import (
+    embedding_model_id, get_tokenizer, load_embeddings, read_index_model_id, write_index_model_id
+)
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -24,127 +35,308 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+_MULTI_NL = re.compile(r'\n{3,}')
+# Filename delimiters for the bike model heuristic (_, - and whitespace) mapped to a single space
+_MODEL_DELIMS = str.maketrans({c: ' ' for c in '_-\t\n\r\x0b\x0c'})
+
 @dataclass
 class IngestionConfig:
     source_dir: str = "bike_manuals"
-    persist_dir: str = "./chroma_db"
-    # User requested upgrade to a stronger model
-    embedding_model: str = "sentence-transformers/all-mpnet-base-v2"
+    # Index location and embedding model are shared with rag_retrieval via rag_settings
+    persist_dir: str = rag_settings.PERSIST_DIR
+    embedding_model: str = rag_settings.EMBEDDING_MODEL
+    embedding_backend: str = rag_settings.EMBEDDING_BACKEND
+    onnx_dir: str = rag_settings.ONNX_DIR
+    onnx_quantize: bool = rag_settings.ONNX_QUANTIZE
     chunk_size: int = 800  # Smaller chunks for manuals
     chunk_overlap: int = 200
-    registry_file: str = "processed_files.json"
+    embedding_batch_size: int = rag_settings.EMBEDDING_BATCH_SIZE
+    add_batch_size: int = 256  # Texts per vector store insert
+    flush_batch_size: int = 512  # Chunks accumulated across files before embedding + insert
+    # Extra int8 range on each side of the trained per-dimension min/max, as a fraction of that range
+    quantizer_range_margin: float = 0.2
+    registry_file: str = "processed_files.db"  # SQLite
     separators: List[str] = field(default_factory=lambda: ["\n\n", "\n", " ", ""])
+    # PDF parsing is CPU-bound, so fan files out across processes
+    num_workers: int = field(default_factory=lambda: min(os.cpu_count() or 1, 4))
 
 class DocumentProcessor:
     def __init__(self, config: IngestionConfig):
         self.config = config
+        # Smart Split
+        self.text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=self.config.chunk_size,
+            chunk_overlap=self.config.chunk_overlap,
+            separators=self.config.separators
+        )
 
     def calculate_file_hash(self, file_path: str) -> str:
-        """Calculate MD5 hash of a file to track changes."""
-        hasher = hashlib.md5()
+        """Calculate BLAKE2b hash of a file to track changes, streaming it in 1 MiB chunks."""
+        hasher = hashlib.blake2b(digest_size=16)
         with open(file_path, 'rb') as f:
-            buf = f.read()
-            hasher.update(buf)
+            while chunk := f.read(1 << 20):
+                hasher.update(chunk)
         return hasher.hexdigest()
 
-    def extract_metadata(self, file_path: str) -> Dict:
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def extract_metadata(file_path: str) -> Dict:
         """
         Extract metadata from filename. 
         Enriching with 'bike_model' helps in filtering during retrieval.
+        Cached per path (same for every page); callers must copy, not mutate, the result.
         """
         filename = os.path.basename(file_path)
         # Attempt to extract bike model (assuming format like "ModelName_Manual.pdf")
         # Simple heuristic: take the first part before _, -, or space
-        bike_model = re.split(r'[_\-\s]', filename)[0]
+        bike_model = filename.translate(_MODEL_DELIMS).split(' ', 1)[0]
         return {
             "source": filename,
             "bike_model": bike_model,
             "file_path": str(file_path)
         }
 
-    def process_file(self, file_path: str) -> List[Document]:
-        """Load, clean, and split a single PDF file."""
-        loader = PyPDFLoader(file_path)
-        try:
-            raw_docs = loader.load()
-        except Exception as e:
-            logger.error(f"Failed to load {file_path}: {e}")
-            return []
+    def process_file(self, file_path: str) -> Iterator[Document]:
+        """Lazily load, clean, and split a single PDF file, one page at a time."""
+        loader = PyMuPDFLoader(file_path)
+        # Same for every page of this file
+        meta = self.extract_metadata(file_path)
 
-        cleaned_docs = []
-        for doc in raw_docs:
+        for doc in loader.lazy_load():
             # Filter empty or too short pages (likely cover pages or blank)
             if not doc.page_content or len(doc.page_content.strip()) < 50:
                 continue
             
             # Enrich metadata
-            doc.metadata.update(self.extract_metadata(file_path))
+            doc.metadata.update(meta)
             
             # Basic cleaning
             doc.page_content = self.clean_text(doc.page_content)
-            cleaned_docs.append(doc)
-            
-        # Smart Split
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=self.config.chunk_size,
-            chunk_overlap=self.config.chunk_overlap,
-            separators=self.config.separators
-        )
-        return text_splitter.split_documents(cleaned_docs)
+            yield from self.text_splitter.split_documents([doc])
 
     @staticmethod
     def clean_text(text: str) -> str:
         """Remove extra whitespace and artifacts."""
         # Replace multiple newlines with double newline (preserve paragraph structure)
-        text = re.sub(r'\n{3,}', '\n\n', text)
+        text = _MULTI_NL.sub('\n\n', text)
         # Replace non-breaking spaces
         text = text.replace('\xa0', ' ')
         return text.strip()
 
+def _process_pdf(config: IngestionConfig, file_path: str, file_hash: str) -> Tuple[str, str, List[Document]]:
+    """Worker entry point: parse and split one PDF in a pool process."""
+    processor = DocumentProcessor(config)
+    # Chunks are materialized here because results are pickled back to the main process;
+    # raw pages are still streamed one at a time
+    try:
+        docs = list(processor.process_file(file_path))
+    except Exception as e:
+        logger.error(f"Failed to load {file_path}: {e}")
+        docs = []
+    return os.path.basename(file_path), file_hash, docs
+
 class VectorDatabase:
     def __init__(self, config: IngestionConfig):
         self.config = config
-        self.embeddings = HuggingFaceEmbeddings(model_name=self.config.embedding_model)
-        self.vectorstore = Chroma(
-            persist_directory=self.config.persist_dir,
-            embedding_function=self.embeddings
+        self.embeddings = load_embeddings(
+            self.config.embedding_model,
+            backend=self.config.embedding_backend,
+            batch_size=self.config.embedding_batch_size,
+            onnx_dir=self.config.onnx_dir,
+            quantize=self.config.onnx_quantize,
         )
+        self._model_id = embedding_model_id(self.embeddings)
+        self.vectorstore = self._load_vectorstore()
+        self.conn = sqlite3.connect(self.config.registry_file)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS processed(filename TEXT PRIMARY KEY, hash TEXT)")
+        # Content-addressed embedding cache: re-ingests (e.g. after chunking changes) skip known chunks
+        self.conn.execute("CREATE TABLE IF NOT EXISTS emb_cache(text_hash TEXT PRIMARY KEY, vec BLOB)")
         self.registry = self._load_registry()
+        if self.vectorstore.index.ntotal == 0 and self.registry:
+            # Registry points at an index that no longer exists (e.g. deleted or older store): re-ingest
+            logger.warning("Vector index is empty; clearing processed files registry.")
+            self._clear_registry()
+        # Chunks waiting to be written, and the files they complete
+        self._pending: List[Document] = []
+        self._pending_files: List[Tuple[str, str]] = []
+        # Embedded chunks held back until a new index has been trained (see flush)
+        self._embedded: List[Document] = []
+        self._embedded_vectors: List[np.ndarray] = []
+
+    def _load_vectorstore(self) -> FAISS:
+        """
+        Load the FAISS index, or create an empty one.
+        Vectors are stored as int8 (per-dimension scalar quantization): 4x smaller than FP32.
+        """
+        if os.path.exists(os.path.join(self.config.persist_dir, "index.faiss")):
+            stored_model_id = read_index_model_id(self.config.persist_dir)
+            if stored_model_id != self._model_id:
+                # Vectors from different models are not comparable: start a fresh index (registry is cleared below)
+                logger.warning(
+                    f"Index in '{self.config.persist_dir}' was built with '{stored_model_id}', "
+                    f"not '{self._model_id}'; rebuilding it."
+                )
+                return self._new_vectorstore()
+            return FAISS.load_local(
+                self.config.persist_dir,
+                self.embeddings,
+                allow_dangerous_deserialization=True,  # Docstore pickle is written by this script
+                distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+            )
+
+        return self._new_vectorstore()
+
+    def _new_vectorstore(self) -> FAISS:
+        """Create an empty int8 scalar-quantized FAISS store (trained on the first write)."""
+        dim = len(self.embeddings.embed_query("dimension probe"))
+        # Embeddings are L2-normalized, so inner product == cosine similarity
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        # Later manuals are quantized with these ranges (an SQ index cannot be retrained), so leave headroom
+        index.sq.rangestat = faiss.ScalarQuantizer.RS_minmax
+        index.sq.rangestat_arg = self.config.quantizer_range_margin
+        return FAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=InMemoryDocstore(),
+            index_to_docstore_id={},
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+        )
+
+    def _embed_sorted(self, docs: List[Document]) -> List[List[float]]:
+        """
+        Embed chunks in batches of similar token length.
+        Each batch is only padded to its own longest chunk instead of the global one.
+        """
+        texts = [doc.page_content for doc in docs]
+        tokenizer = get_tokenizer(self.embeddings)
+        lengths = [len(ids) for ids in tokenizer(texts, truncation=True)["input_ids"]]
+        order = np.argsort(lengths, kind="stable")
+
+        # Embed in sorted order, then write each vector back to its original position
+        vectors: List[Optional[List[float]]] = [None] * len(texts)
+        batch_size = self.config.embedding_batch_size
+        for start in range(0, len(order), batch_size):
+            idx = order[start:start + batch_size]
+            batch_vectors = self.embeddings.embed_documents([texts[i] for i in idx])
+            for i, vec in zip(idx, batch_vectors):
+                vectors[i] = vec
+        return vectors
+
+    def _text_key(self, text: str) -> str:
+        """Cache key for a chunk; includes the loaded model so vectors from other weights are never reused."""
+        return hashlib.blake2b(f"{self._model_id}\0{text}".encode(), digest_size=16).hexdigest()
+
+    def _embed_cached(self, docs: List[Document]) -> List[List[float]]:
+        """Embed chunks, reusing vectors from the SQLite embedding cache and embedding only the misses."""
+        keys = [self._text_key(doc.page_content) for doc in docs]
+
+        vectors: Dict[str, List[float]] = {}
+        unique_keys = list(set(keys))
+        for start in range(0, len(unique_keys), 500):  # Stay under SQLite's bound-parameter limit
+            batch = unique_keys[start:start + 500]
+            rows = self.conn.execute(
+                f"SELECT text_hash, vec FROM emb_cache WHERE text_hash IN ({','.join('?' * len(batch))})",
+                batch
+            )
+            vectors.update((key, np.frombuffer(vec, dtype=np.float32).tolist()) for key, vec in rows)
+
+        # First occurrence of every uncached chunk
+        missing: Dict[str, Document] = {}
+        for key, doc in zip(keys, docs):
+            if key not in vectors:
+                missing.setdefault(key, doc)
+        logger.info(f"Embedding cache: {len(keys) - len(missing)} hits, {len(missing)} chunks to embed.")
+
+        if missing:
+            new_vectors = self._embed_sorted(list(missing.values()))
+            vectors.update(zip(missing.keys(), new_vectors))
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO emb_cache(text_hash, vec) VALUES (?, ?)",
+                [(key, np.asarray(vec, dtype=np.float32).tobytes()) for key, vec in zip(missing.keys(), new_vectors)]
+            )
+            self.conn.commit()
+        return [vectors[key] for key in keys]
 
     def _load_registry(self) -> Dict[str, str]:
-        """Load the processed files registry from JSON."""
-        if os.path.exists(self.config.registry_file):
-            try:
-                with open(self.config.registry_file, 'r') as f:
-                    return json.load(f)
-            except json.JSONDecodeError:
-                return {}
-        return {}
-
-    def _save_registry(self):
-        """Save the registry to disk."""
-        with open(self.config.registry_file, 'w') as f:
-            json.dump(self.registry, f, indent=2)
+        """Load the processed files registry from SQLite into memory for fast lookups."""
+        return dict(self.conn.execute("SELECT filename, hash FROM processed"))
+
+    def _clear_registry(self):
+        """Forget all processed files."""
+        self.conn.execute("DELETE FROM processed")
+        self.conn.commit()
+        self.registry = {}
 
     def is_processed(self, filename: str, file_hash: str) -> bool:
         """Check if file is already processed with the same hash."""
         return self.registry.get(filename) == file_hash
 
     def mark_processed(self, filename: str, file_hash: str):
-        """Update registry with new file hash."""
+        """Update registry with new file hash (single-row write)."""
         self.registry[filename] = file_hash
-        self._save_registry()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO processed(filename, hash) VALUES (?, ?)",
+            (filename, file_hash)
+        )
+        self.conn.commit()
+
+    def add_documents(self, documents: List[Document], filename: Optional[str] = None, file_hash: Optional[str] = None):
+        """
+        Queue documents for the vector store; they are embedded and written once `flush_batch_size`
+        chunks are pending. If given, the file is marked processed only after its chunks have been written.
+        """
+        self._pending.extend(documents)
+        if filename is not None:
+            self._pending_files.append((filename, file_hash))
+        if len(self._pending) >= self.config.flush_batch_size:
+            self.flush()
 
-    def add_documents(self, documents: List[Document]):
-        """Add documents to the Chroma vector store."""
-        if not documents:
+    def flush(self, final: bool = False):
+        """
+        Embed all pending documents (vectors are cached as they go), write them to the FAISS store,
+        persist it, then update the registry.
+        A new index is trained once on every chunk of the first run, so until the `final` flush only the
+        embedding happens; training and insertion are deferred.
+        """
+        if self._pending:
+            # Embedding cache is committed per batch, so a crash late in the run keeps earlier work
+            self._embedded.extend(self._pending)
+            self._embedded_vectors.append(np.asarray(self._embed_cached(self._pending), dtype=np.float32))
+            self._pending = []
+
+        if not self.vectorstore.index.is_trained and not final:
             return
-        
-        self.vectorstore.add_documents(documents)
-        # self.vectorstore.persist() # Auto-persists in newer versions
+
+        if self._embedded:
+            self._write_documents(self._embedded, np.concatenate(self._embedded_vectors))
+        for filename, file_hash in self._pending_files:
+            self.mark_processed(filename, file_hash)
+        self._embedded = []
+        self._embedded_vectors = []
+        self._pending_files = []
+
+    def _write_documents(self, documents: List[Document], embeddings: np.ndarray):
+        """Add pre-embedded documents to the FAISS vector store and persist it."""
+        index = self.vectorstore.index
+        if not index.is_trained:
+            # int8 ranges per dimension are learned once, from every chunk of the first run (see flush)
+            logger.info(f"Training int8 quantizer on {len(embeddings)} chunk embeddings.")
+            index.train(embeddings)
+
+        batch_size = self.config.add_batch_size
+        for start in range(0, len(documents), batch_size):
+            batch = documents[start:start + batch_size]
+            self.vectorstore.add_embeddings(
+                text_embeddings=list(zip([doc.page_content for doc in batch], embeddings[start:start + batch_size])),
+                metadatas=[doc.metadata for doc in batch],
+            )
+        self.vectorstore.save_local(self.config.persist_dir)
+        write_index_model_id(self.config.persist_dir, self._model_id)
 
     def query(self, query_text: str, k: int = 3):
         """Run a validation query."""
+        if self.vectorstore.index.ntotal == 0:
+            return []
         return self.vectorstore.similarity_search(query_text, k=k)
 
 class RAGPipeline:
@@ -163,8 +355,9 @@ class RAGPipeline:
         pdf_files = list(source_path.glob("**/*.pdf"))
         logger.info(f"Found {len(pdf_files)} PDF files in {self.config.source_dir}.")
 
-        new_docs_count = 0
-        
+        # Hash and filter in the main process; only the main process touches the registry/vector store
+        pending_paths = []
+        pending_hashes = []
         for file_path in pdf_files:
             str_path = str(file_path)
             # Calculate hash to check for changes
@@ -176,16 +369,27 @@ class RAGPipeline:
                 logger.info(f"Skipping '{filename}' (already processed and unchanged).")
                 continue
             
-            logger.info(f"Processing '{filename}'...")
-            docs = self.processor.process_file(str_path)
-            
-            if docs:
-                self.db.add_documents(docs)
-                self.db.mark_processed(filename, file_hash)
-                new_docs_count += len(docs)
-                logger.info(f"Successfully added {len(docs)} chunks from '{filename}'.")
-            else:
-                logger.warning(f"No valid content found in '{filename}'.")
+            logger.info(f"Queued '{filename}' for processing.")
+            pending_paths.append(str_path)
+            pending_hashes.append(file_hash)
+
+        new_docs_count = 0
+
+        if pending_paths:
+            worker = partial(_process_pdf, self.config)
+            # Spawn, not fork: the parent already holds embedding runtime threads (ORT/torch, maybe CUDA)
+            # and an open SQLite connection, none of which are safe to copy into children
+            spawn = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=self.config.num_workers, mp_context=spawn) as ex:
+                for filename, file_hash, docs in ex.map(worker, pending_paths, pending_hashes):
+                    if docs:
+                        self.db.add_documents(docs, filename, file_hash)
+                        new_docs_count += len(docs)
+                        logger.info(f"Collected {len(docs)} chunks from '{filename}'.")
+                    else:
+                        logger.warning(f"No valid content found in '{filename}'.")
+            # Write the last partial batch before validating
+            self.db.flush(final=True)
 
         if new_docs_count > 0:
             logger.info(f"Ingestion complete. Total new chunks added: {new_docs_count}")
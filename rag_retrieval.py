@@ -1,19 +1,145 @@
 import os
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
 from dotenv import load_dotenv
 
+import rag_settings
+
 # Global variables
+embeddings = None
 vector_store = None
 llm = None
-PROMPT = None
+
+# Custom prompt, kept as a plain str and filled with str.format on the hot path
+PROMPT = """Use the following pieces of context to answer the question at the end.
+If you don't know the answer, just say that you don't know, don't try to make up an answer.
+IMPORTANT: After answering, please provide a 'Context Adherence Score' (0-100%) indicating how much of your answer is based strictly on the provided context vs your general knowledge.
+
+Context:
+{context}
+
+Question: {question}
+
+Answer:"""
+
+# Answer cache: normalized question -> (timestamp, response), least recently used evicted first
+CACHE_MAX_ENTRIES = 256
+CACHE_TTL_SECONDS = 600
+_answer_cache = OrderedDict()
+# get_answer runs on worker threads (server offloads it), so guard shared state
+_cache_lock = threading.Lock()
+_init_lock = threading.Lock()
+# How often the server retries a failed initialization (e.g. no index yet, download timeout)
+# and checks whether ingestion has rewritten the index
+REFRESH_INTERVAL_SECONDS = 30
+# Version (mtime) of the index currently loaded, see _index_version
+_loaded_index_version = None
+
+def clear_cache():
+    """Drop cached answers and query vectors. Called whenever the index is (re)loaded."""
+    with _cache_lock:
+        _answer_cache.clear()
+    _embed_query.cache_clear()
+
+def is_ready():
+    """True once initialize_rag() has completed successfully."""
+    return vector_store is not None and llm is not None
+
+def _index_version():
+    """mtime of the index docstore; FAISS.save_local writes it last, so it changes on every ingestion write."""
+    try:
+        return os.stat(os.path.join(rag_settings.PERSIST_DIR, "index.pkl")).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def ensure_initialized():
+    """
+    Initialize the pipeline if it is not ready yet, or reload the index if ingestion rewrote it.
+    Returns is_ready(). Never waits: if another thread holds the init lock, returns right away.
+    """
+    global vector_store, _loaded_index_version
+    ready = is_ready()
+    if ready and _index_version() == _loaded_index_version:
+        return True
+    if not _init_lock.acquire(blocking=False):
+        return ready
+    try:
+        if not is_ready():
+            initialize_rag()
+        elif _index_version() != _loaded_index_version:
+            print("Index changed on disk, reloading Vector DB...")
+            version = _index_version()
+            vector_store = _load_vector_store(embeddings)
+            _loaded_index_version = version
+            # Answers and query vectors cached against the previous index are stale now
+            clear_cache()
+    except Exception as e:
+        # initialize_rag reports its own failures; a failed reload keeps serving the previous index
+        if ready:
+            print(f"Failed to reload index, keeping the previous one: {e}")
+    finally:
+        _init_lock.release()
+    return is_ready()
+
+def _normalize_question(question):
+    return " ".join(question.split()).lower()
+
+@lru_cache(maxsize=1024)
+def _embed_query(question):
+    """Embed a question once; repeats and retries reuse the vector."""
+    return tuple(embeddings.embed_query(question))
+
+def _dedupe_by_page(documents):
+    """Keep the first chunk per (source, page); chunks from the same page largely overlap."""
+    seen = set()
+    unique = []
+    for doc in documents:
+        key = (doc.metadata.get("source"), doc.metadata.get("page"))
+        if key not in seen:
+            seen.add(key)
+            unique.append(doc)
+    return unique
+
+def _serialize_documents(documents):
+    """Convert retrieved documents to plain dicts so cached responses hold no live store objects."""
+    return [
+        {
+            "content": doc.page_content,
+            "source": os.path.basename(doc.metadata.get("source", "")),
+            "page": doc.metadata.get("page", "Unknown")
+        }
+        for doc in documents
+    ]
+
+def _load_vector_store(embeddings):
+    """Load the FAISS index written by ingest_manuals.py, checking it was built with the same model."""
+    from embedding_models import embedding_model_id, read_index_model_id
+    from langchain_community.vectorstores import FAISS
+    from langchain_community.vectorstores.utils import DistanceStrategy
+
+    store = FAISS.load_local(
+        rag_settings.PERSIST_DIR,
+        embeddings,
+        allow_dangerous_deserialization=True,  # Index is produced locally by ingest_manuals.py
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+    )
+    # Querying with a different model than the one that built the index gives meaningless results
+    index_model_id = read_index_model_id(rag_settings.PERSIST_DIR)
+    if index_model_id != embedding_model_id(embeddings):
+        raise ValueError(
+            f"Index in '{rag_settings.PERSIST_DIR}' was built with '{index_model_id}', but the server uses "
+            f"'{embedding_model_id(embeddings)}'. Re-run ingest_manuals.py."
+        )
+    return store
 
 def initialize_rag():
-    global vector_store, llm, PROMPT
+    global embeddings, vector_store, llm, _loaded_index_version
     try:
         print("Initializing RAG pipeline (Manual Mode)...")
         from langchain_google_genai import ChatGoogleGenerativeAI
-        from langchain_huggingface import HuggingFaceEmbeddings
-        from langchain_community.vectorstores import Chroma
-        from langchain_core.prompts import PromptTemplate
+        from embedding_models import load_embeddings
 
         # Load environment variables from .env file
         load_dotenv()
@@ -26,31 +152,27 @@ def initialize_rag():
 
         # Initialize Embeddings
         print("Loading embeddings...")
-        embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-mpnet-base-v2")
+        # Same model, backend and index location as ingestion, so queries match the stored vectors
+        embeddings = load_embeddings(
+            rag_settings.EMBEDDING_MODEL,
+            backend=rag_settings.EMBEDDING_BACKEND,
+            batch_size=rag_settings.EMBEDDING_BATCH_SIZE,
+            onnx_dir=rag_settings.ONNX_DIR,
+            quantize=rag_settings.ONNX_QUANTIZE,
+        )
 
         # Load Vector DB
         print("Loading Vector DB...")
-        vector_store = Chroma(persist_directory="./chroma_db", embedding_function=embeddings)
+        version = _index_version()  # Read before loading so a write during the load triggers a reload
+        vector_store = _load_vector_store(embeddings)
+        _loaded_index_version = version
+        # Answers and query vectors cached against a previous index/model are stale now
+        clear_cache()
 
         # Initialize LLM
         print("Loading LLM...")
         llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash-lite")
 
-        # Create Custom Prompt Template
-        template = """Use the following pieces of context to answer the question at the end.
-If you don't know the answer, just say that you don't know, don't try to make up an answer.
-IMPORTANT: After answering, please provide a 'Context Adherence Score' (0-100%) indicating how much of your answer is based strictly on the provided context vs your general knowledge.
-
-Context:
-{context}
-
-Question: {question}
-
-Answer:"""
-
-        PROMPT = PromptTemplate(
-            template=template, input_variables=["context", "question"]
-        )
         print("RAG pipeline initialized successfully.")
 
     except Exception as e:
@@ -58,36 +180,49 @@ Answer:"""
         raise e
 
 def get_answer(question):
-    global vector_store, llm, PROMPT
-    
-    # Initialize if needed
-    if vector_store is None:
-        try:
-            initialize_rag()
-        except Exception as e:
-            return {"result": f"System Error: Failed to initialize RAG pipeline. {e}", "source_documents": []}
+    # Initialized eagerly at server startup; the server retries/reloads in the background
+    if not is_ready():
+        return {"result": "System Error: RAG pipeline is not initialized. Check the server log; it will retry.", "source_documents": []}
+
+    cache_key = _normalize_question(question)
+    with _cache_lock:
+        cached = _answer_cache.get(cache_key)
+        if cached is not None and time.monotonic() - cached[0] < CACHE_TTL_SECONDS:
+            _answer_cache.move_to_end(cache_key)
+            print(f"Question (cached): {question}")
+            return cached[1]
 
     print(f"Question: {question}")
     try:
         # 1. Retrieve relevant documents
         print("Retrieving documents...")
-        source_documents = vector_store.similarity_search(question, k=4)
+        query_vector = _embed_query(question)
+        # MMR: fetch 20 candidates, keep 4 diverse ones (manual boilerplate repeats a lot)
+        source_documents = _dedupe_by_page(vector_store.max_marginal_relevance_search_by_vector(
+            list(query_vector), k=4, fetch_k=20, lambda_mult=0.5
+        ))
         
-        # 2. Prepare Context
-        context = "\n\n".join([doc.page_content for doc in source_documents])
-        
-        # 3. Generate Answer
+        # 2. Prepare Context + 3. Generate Answer
         print("Generating answer...")
-        formatted_prompt = PROMPT.format(context=context, question=question)
+        formatted_prompt = PROMPT.format(
+            context="\n\n".join(doc.page_content for doc in source_documents),
+            question=question
+        )
         response = llm.invoke(formatted_prompt)
         
         # Response is an AIMessage object
         result_text = response.content
         
-        return {
+        response = {
             "result": result_text,
-            "source_documents": source_documents
-        }  
+            "source_documents": _serialize_documents(source_documents)
+        }
+        with _cache_lock:
+            _answer_cache[cache_key] = (time.monotonic(), response)
+            _answer_cache.move_to_end(cache_key)
+            if len(_answer_cache) > CACHE_MAX_ENTRIES:
+                _answer_cache.popitem(last=False)
+        return response
     except Exception as e:
         print(f"Error running chain: {e}")
         import traceback
@@ -95,6 +230,7 @@ def get_answer(question):
         return {"result": f"Error: {e}", "source_documents": []}
 
 if __name__ == "__main__":
+    initialize_rag()
     question = "How do I check the engine oil level?"
     result = get_answer(question)
     print("\nAnswer:")
@@ -106,7 +242,7 @@ if __name__ == "__main__":
     if 'source_documents' in result:
         for i, doc in enumerate(result['source_documents']):
             print(f"\nDocument {i+1}:")
-            print(f"Source: {doc.metadata.get('source', 'Unknown')}")
-            print(f"Content Preview: {doc.page_content[:200]}...")
+            print(f"Source: {doc['source'] or 'Unknown'}")
+            print(f"Content Preview: {doc['content'][:200]}...")
             print("-" * 20)
 
@@ -0,0 +1,11 @@
+# Settings shared by ingestion (ingest_manuals.py) and retrieval (rag_retrieval.py).
+# Both sides must agree on these, or the server would query the index with a different model.
+# Kept dependency-free so importing it has no side effects.
+
+PERSIST_DIR = "./faiss_index"
+# User requested upgrade to a stronger model
+EMBEDDING_MODEL = "sentence-transformers/all-mpnet-base-v2"
+EMBEDDING_BACKEND = "onnx"  # "onnx" (ONNX Runtime via Optimum) or "torch"
+ONNX_DIR = "mpnet_onnx"
+ONNX_QUANTIZE = False  # Export and serve an INT8 dynamic-quantized model
+EMBEDDING_BATCH_SIZE = 64
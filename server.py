@@ -1,16 +1,37 @@
+import asyncio
 import os
+import time
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from rag_retrieval import get_answer
-import glob
+from rag_retrieval import REFRESH_INTERVAL_SECONDS, ensure_initialized, get_answer, is_ready
 
-app = FastAPI()
+async def _refresh_pipeline():
+    # Retry a failed startup (e.g. index not built yet) and pick up re-ingested indexes, without a restart
+    while True:
+        await asyncio.sleep(REFRESH_INTERVAL_SECONDS)
+        await asyncio.to_thread(ensure_initialized)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load embeddings, vector DB and LLM before accepting traffic, not on the first request.
+    # On failure keep serving (/healthz reports 503); the refresh task retries.
+    await asyncio.to_thread(ensure_initialized)
+    refresh_task = asyncio.create_task(_refresh_pipeline())
+    yield
+    refresh_task.cancel()
+
+app = FastAPI(lifespan=lifespan)
 
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 app.mount("/manuals", StaticFiles(directory="bike_manuals"), name="manuals")
 
+# Cached PDF listing for /api/sources, refreshed at most every SOURCES_TTL_SECONDS
+SOURCES_TTL_SECONDS = 10
+_sources_cache = {"ts": 0.0, "files": []}
+
 class Query(BaseModel):
     question: str
 
@@ -18,24 +39,22 @@ class Query(BaseModel):
 async def read_root():
     return {"message": "Welcome to Bike RAG API. Go to /static/index.html to use the UI."}
 
+@app.get("/healthz")
+async def healthz():
+    if not is_ready():
+        raise HTTPException(status_code=503, detail="RAG pipeline is not initialized")
+    return {"status": "ok"}
+
 @app.post("/api/chat")
 async def chat(query: Query):
     try:
-        response = get_answer(query.question)
-        
-        # Serialize source documents
-        sources = []
-        if "source_documents" in response:
-            for doc in response["source_documents"]:
-                sources.append({
-                    "content": doc.page_content,
-                    "source": os.path.basename(doc.metadata.get("source", "")),
-                    "page": doc.metadata.get("page", "Unknown")
-                })
+        # Retrieval and the LLM call block; run them off the event loop so requests overlap
+        response = await asyncio.to_thread(get_answer, query.question)
         
+        # Source documents are already serialized to plain dicts
         return {
             "answer": response["result"],
-            "sources": sources
+            "sources": response.get("source_documents", [])
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -43,8 +62,15 @@ async def chat(query: Query):
 @app.get("/api/sources")
 async def get_sources():
     # List all PDFs in the bike_manuals directory
-    files = glob.glob("bike_manuals/*.pdf")
-    return {"files": [os.path.basename(f) for f in files]}
+    now = time.monotonic()
+    if not _sources_cache["ts"] or now - _sources_cache["ts"] > SOURCES_TTL_SECONDS:
+        with os.scandir("bike_manuals") as entries:
+            _sources_cache["files"] = [
+                e.name for e in entries
+                if e.name.lower().endswith(".pdf") and not e.name.startswith(".") and e.is_file()
+            ]
+        _sources_cache["ts"] = now
+    return {"files": _sources_cache["files"]}
 
 if __name__ == "__main__":
     import uvicorn